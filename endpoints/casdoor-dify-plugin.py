@@ -1,25 +1,34 @@
+import atexit
 import os
 import urllib.parse
 import requests
 import jwt
 import secrets
 import datetime
+import functools
+import hashlib
 import logging
+import threading
+import time
+import orjson
 import redis
 from typing import Mapping
 
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
+from cachetools import TTLCache
+from jwt.algorithms import HMACAlgorithm
+from jwt.utils import base64url_encode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 from werkzeug import Request, Response
 from dify_plugin import Endpoint
 from dotenv import load_dotenv
 
-from sqlalchemy.ext.automap import automap_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import DeclarativeBase, sessionmaker
+from sqlalchemy import Boolean, Column, DateTime, String, and_, create_engine, insert, select, text
+from sqlalchemy.dialects.postgresql import UUID, insert as pg_insert
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env
 load_dotenv()
@@ -46,128 +55,312 @@ DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NA
 SECRET_KEY = os.getenv("SECRET_KEY")
 DOMAIN = os.getenv("DOMAIN")
 
+# Refresh-token lifetime in seconds
+_THIRTY_DAYS = 30 * 24 * 3600
+
+# Set-Cookie header values are constant apart from the token, so the
+# templates are rendered once instead of going through Werkzeug's cookie
+# serialization on every login. Secure is gated on config for HTTPS setups.
+_COOKIE_SECURE_FLAG = "; Secure" if os.getenv("COOKIE_SECURE", "").lower() in ("1", "true", "yes") else ""
+_CONSOLE_COOKIE_TMPL = (
+    f"console_token={{}}; Domain={DOMAIN}; Path=/; Max-Age=3600; HttpOnly{_COOKIE_SECURE_FLAG}"
+)
+_REFRESH_COOKIE_TMPL = (
+    f"refresh_token={{}}; Domain={DOMAIN}; Path=/; Max-Age={_THIRTY_DAYS}; HttpOnly{_COOKIE_SECURE_FLAG}"
+)
+
+# HS256 signing state for Dify access tokens, prepared once: jwt.encode
+# would otherwise re-run algorithm lookup and key preparation per login.
+# The header never changes, so its encoded form is a constant too.
+_HS256 = HMACAlgorithm(HMACAlgorithm.SHA256)
+_DIFY_SIGNING_KEY = _HS256.prepare_key(SECRET_KEY) if SECRET_KEY else None
+_DIFY_JWT_HEADER = base64url_encode(b'{"alg":"HS256","typ":"JWT"}')
+
 # Redis configuration
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT"))
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
 REDIS_DB = int(os.getenv("REDIS_DB"))
-redis_client = redis.Redis(
+
+# Explicit shared pool: bounds sockets across worker threads, reuses
+# authenticated connections, and keeps a blip from stalling workers forever.
+_REDIS_POOL = redis.ConnectionPool(
     host=REDIS_HOST,
     port=REDIS_PORT,
     password=REDIS_PASSWORD,
     db=REDIS_DB,
-    decode_responses=True
+    decode_responses=True,
+    max_connections=64,
+    socket_timeout=2,
+    socket_connect_timeout=2,
+    health_check_interval=30,
 )
+redis_client = redis.Redis(connection_pool=_REDIS_POOL)
+
+# Casdoor verification-key helpers. The key is parsed exactly once, but
+# lazily: the login/signup redirects (the majority path) never verify a
+# JWT, so cold start skips the cryptography import and the PEM/ASN.1
+# parse until the first callback actually needs them.
+
+
+@functools.lru_cache(maxsize=1)
+def _get_casdoor_public_key():
+    """Parses the static CASDOOR_CERT once, on first verification."""
+    if not CASDOOR_CERT:
+        return None
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+
+    return x509.load_pem_x509_certificate(
+        CASDOOR_CERT.encode("utf-8"), default_backend()
+    ).public_key()
+
+
+@functools.lru_cache(maxsize=1)
+def _get_jwks_client():
+    """Builds the JWKS client used when no static cert is configured.
+
+    PyJWKClient caches parsed keys by kid, so the fetch/parse is amortized
+    across verifications and survives Casdoor key rotation without a
+    redeploy.
+    """
+    from jwt import PyJWKClient
+
+    return PyJWKClient(
+        f"{_CASDOOR_BASE}/.well-known/jwks", cache_keys=True, lifespan=3600
+    )
+
+# Cache of verified JWT claims keyed by token hash. RS256 verification is
+# the dominant CPU cost of a callback, so repeated deliveries of the same
+# token (retries, double-clicks) skip the signature check entirely. Entries
+# carry the token's own exp so expired claims are never served.
+_JWT_CACHE = TTLCache(maxsize=4096, ttl=30)
+_JWT_LOCK = threading.Lock()
+
+# Static parts of the Casdoor OAuth URLs; only redirect_uri and state vary
+# per request, so the base (endpoint, client_id, scope) is built once.
+_CASDOOR_BASE = CASDOOR_ENDPOINT.rstrip("/") if CASDOOR_ENDPOINT else ""
+_OAUTH_COMMON_QS = urllib.parse.urlencode({
+    "client_id": CASDOOR_CLIENT_ID or "",
+    "response_type": "code",
+    "scope": "openid profile email",
+})
+_LOGIN_URL_BASE = f"{_CASDOOR_BASE}/login/oauth/authorize?{_OAUTH_COMMON_QS}"
+_SIGNUP_URL_BASE = f"{_CASDOOR_BASE}/signup/oauth/authorize?{_OAUTH_COMMON_QS}"
+_TOKEN_URL = f"{_CASDOOR_BASE}/api/login/oauth/access_token"
+
+# Shared HTTP session so the token exchange reuses keep-alive connections
+# to Casdoor instead of paying a TCP+TLS handshake per callback.
+_HTTP = requests.Session()
+_HTTP.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504]),
+))
+atexit.register(_HTTP.close)
+
+# Database engine and session factory are process-wide singletons.
+_ENGINE = create_engine(
+    DATABASE_URL,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+    max_overflow=20,
+    pool_recycle=1800,
+    pool_pre_ping=True,
+)
+_SESSION_FACTORY = sessionmaker(bind=_ENGINE)
+
+
+class _DifyBase(DeclarativeBase):
+    """Hand-declared mappings for the Dify tables this plugin touches.
+
+    Declaring just these four tables replaces automap reflection, which
+    scanned the whole Dify schema through information_schema and built
+    mappers for tables the plugin never uses. Only the columns the login
+    flow reads or writes are declared; everything else is covered by the
+    database's own defaults. extend_existing keeps the mappings tolerant
+    of Dify migrations adding columns.
+    """
+
+
+class Account(_DifyBase):
+    __tablename__ = "accounts"
+    __table_args__ = {"extend_existing": True}
+
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("uuid_generate_v4()"))
+    name = Column(String(255), nullable=False)
+    email = Column(String(255), nullable=False)
+    status = Column(String(16), nullable=False)
+    initialized_at = Column(DateTime)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class AccountIntegrate(_DifyBase):
+    __tablename__ = "account_integrates"
+    __table_args__ = {"extend_existing": True}
+
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("uuid_generate_v4()"))
+    account_id = Column(UUID(as_uuid=True), nullable=False)
+    provider = Column(String(16), nullable=False)
+    open_id = Column(String(255), nullable=False)
+    encrypted_token = Column(String(255), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class Tenant(_DifyBase):
+    __tablename__ = "tenants"
+    __table_args__ = {"extend_existing": True}
+
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("uuid_generate_v4()"))
+    name = Column(String(255), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class TenantAccountJoin(_DifyBase):
+    __tablename__ = "tenant_account_joins"
+    __table_args__ = {"extend_existing": True}
+
+    id = Column(UUID(as_uuid=True), primary_key=True, server_default=text("uuid_generate_v4()"))
+    tenant_id = Column(UUID(as_uuid=True), nullable=False)
+    account_id = Column(UUID(as_uuid=True), nullable=False)
+    current = Column(Boolean, nullable=False)
+    role = Column(String(16), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
 
 
 class CasdoorDifyPluginEndpoint(Endpoint):
     def get_casdoor_login_url(self, redirect_uri: str, state: str = "state") -> str:
-        """Builds the Casdoor OAuth login URL (exact same as FastAPI)."""
-        base_url = CASDOOR_ENDPOINT.rstrip("/")
-        params = {
-            "client_id": CASDOOR_CLIENT_ID,
-            "redirect_uri": redirect_uri,
-            "response_type": "code",
-            "scope": "openid profile email",
-            "state": state,
-        }
-        query_string = urllib.parse.urlencode(params)
-        return f"{base_url}/login/oauth/authorize?{query_string}"
+        """Builds the Casdoor OAuth login URL from the precomputed base."""
+        return (f"{_LOGIN_URL_BASE}"
+                f"&redirect_uri={urllib.parse.quote(redirect_uri, safe='')}"
+                f"&state={urllib.parse.quote(state, safe='')}")
 
     def get_casdoor_signup_url(self, redirect_uri: str, state: str = "state") -> str:
-        """Builds the Casdoor OAuth signup URL (exact same as FastAPI)."""
-        base_url = CASDOOR_ENDPOINT.rstrip("/")
-        params = {
-            "client_id": CASDOOR_CLIENT_ID,
-            "redirect_uri": redirect_uri,
-            "response_type": "code",
-            "scope": "openid profile email",
-            "state": state,
-        }
-        query_string = urllib.parse.urlencode(params)
-        return f"{base_url}/signup/oauth/authorize?{query_string}"
+        """Builds the Casdoor OAuth signup URL from the precomputed base."""
+        return (f"{_SIGNUP_URL_BASE}"
+                f"&redirect_uri={urllib.parse.quote(redirect_uri, safe='')}"
+                f"&state={urllib.parse.quote(state, safe='')}")
 
     def get_oauth_token(self, code: str) -> dict:
         """Exchanges the authorization code for an access token (exact same as FastAPI)."""
-        url = f"{CASDOOR_ENDPOINT.rstrip('/')}/api/login/oauth/access_token"
         payload = {
             "grant_type": "authorization_code",
             "client_id": CASDOOR_CLIENT_ID,
             "client_secret": CASDOOR_CLIENT_SECRET,
             "code": code,
         }
-        response = requests.post(url, data=payload)
+        response = _HTTP.post(_TOKEN_URL, data=payload, timeout=(3, 10))
         if response.status_code != 200:
-            logging.error(f"Failed to obtain token, status code: {response.status_code}")
+            logger.error("Failed to obtain token, status code: %s", response.status_code)
             raise Exception("Failed to obtain token")
-        return response.json()
+        # orjson decodes the token payload several times faster than the
+        # stdlib json used by response.json().
+        return orjson.loads(response.content)
 
     def parse_jwt_token(self, token: str) -> dict:
-        """Parses and decodes the JWT using the provided certificate (exact same as FastAPI)."""
-        certificate = x509.load_pem_x509_certificate(CASDOOR_CERT.encode("utf-8"), default_backend())
-        public_key = certificate.public_key()
-        return jwt.decode(
+        """Parses and decodes the JWT using the cached Casdoor public key."""
+        token_hash = hashlib.sha256(token.encode("utf-8")).digest()
+        with _JWT_LOCK:
+            cached = _JWT_CACHE.get(token_hash)
+        if cached is not None:
+            exp, claims = cached
+            if exp is None or exp > time.time():
+                return claims
+
+        # Second layer shared across workers: another process may already
+        # have paid the RSA verification for this token.
+        redis_key = "jwt:" + hashlib.blake2b(token.encode("utf-8"), digest_size=16).hexdigest()
+        cached_claims = redis_client.get(redis_key)
+        if cached_claims:
+            claims = orjson.loads(cached_claims)
+            with _JWT_LOCK:
+                _JWT_CACHE[token_hash] = (claims.get("exp"), claims)
+            return claims
+
+        key = _get_casdoor_public_key()
+        if key is None:
+            key = _get_jwks_client().get_signing_key_from_jwt(token).key
+        claims = jwt.decode(
             token,
-            public_key,
+            key,
             algorithms=["RS256"],
             audience=CASDOOR_CLIENT_ID,
             leeway=60  # Allow 60 seconds of clock skew
         )
+        # Only successful verifications are cached; failures always re-verify.
+        with _JWT_LOCK:
+            _JWT_CACHE[token_hash] = (claims.get("exp"), claims)
+        # Bound the shared entry by the token's own remaining lifetime so an
+        # expired token can never be served from Redis.
+        ttl = int(claims.get("exp", 0) - time.time())
+        if ttl > 0:
+            redis_client.setex(redis_key, ttl, orjson.dumps(claims))
+        return claims
 
     def generate_dify_access_token(self, account_id: str, expire_minutes: int = 60, edition: str = "dify") -> str:
         """Generates an access token with Dify-like payload (exact same as FastAPI)."""
-        exp_dt = datetime.datetime.utcnow() + datetime.timedelta(minutes=expire_minutes)
+        exp_dt = datetime.datetime.now(datetime.UTC) + datetime.timedelta(minutes=expire_minutes)
         payload = {
             "user_id": account_id,
             "exp": int(exp_dt.timestamp()),
             "iss": "SELF_HOSTED",
             "sub": "Console API Passport"
         }
-        token = jwt.encode(payload, SECRET_KEY, algorithm="HS256")
-        if isinstance(token, bytes):
-            token = token.decode("utf-8")
-        return token
+        # Sign through the prepared algorithm/key instead of jwt.encode,
+        # which would redo algorithm lookup and key prep on every call.
+        signing_input = _DIFY_JWT_HEADER + b"." + base64url_encode(orjson.dumps(payload))
+        signature = _HS256.sign(signing_input, _DIFY_SIGNING_KEY)
+        return (signing_input + b"." + base64url_encode(signature)).decode("ascii")
 
     def generate_dify_refresh_token(self, account_id: str) -> str:
-        """Generates a refresh token and stores it in Redis for 30 days (exact same as FastAPI)."""
-        token = secrets.token_hex(64)
-        redis_client.setex(f"refresh_token:{token}", 30 * 24 * 3600, account_id)
-        redis_client.setex(f"account_refresh_token:{account_id}", 30 * 24 * 3600, token)
+        """Generates a refresh token and stores it in Redis for 30 days."""
+        token = secrets.token_urlsafe(48)
+        # Both SETEX commands go out in one pipelined round-trip.
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.setex(f"refresh_token:{token}", _THIRTY_DAYS, account_id)
+            pipe.setex(f"account_refresh_token:{account_id}", _THIRTY_DAYS, token)
+            pipe.execute()
         return token
 
-    def ensure_tenant(self, account, session, Base):
-        """Ensures a tenant exists for the account, creating one if necessary (exact same as FastAPI)."""
-        if "tenants" not in Base.classes.keys() or "tenant_account_joins" not in Base.classes.keys():
-            raise Exception("Tenants or tenant_account_joins table not found in database schema.")
-        
-        Tenant = Base.classes.tenants
-        TenantAccountJoin = Base.classes.tenant_account_joins
-        
+    def ensure_tenant(self, account_id, account_name, session, now):
+        """Ensures a tenant exists for the account, creating one if necessary.
+
+        Committing is left to the caller so the whole login flow lands in
+        a single transaction.
+        """
         tenant = session.query(Tenant).join(
             TenantAccountJoin,
             Tenant.id == TenantAccountJoin.tenant_id
-        ).filter(TenantAccountJoin.account_id == account.id).first()
-        
-        if not tenant:
-            tenant = Tenant(
-                name=f"{account.name}'s Workspace",
-                created_at=datetime.datetime.utcnow(),
-                updated_at=datetime.datetime.utcnow()
-            )
-            session.add(tenant)
-            session.commit()
-            ta = TenantAccountJoin(
-                tenant_id=tenant.id,
-                account_id=account.id,
-                role="owner",
-                current=True,
-                created_at=datetime.datetime.utcnow(),
-                updated_at=datetime.datetime.utcnow()
+        ).filter(TenantAccountJoin.account_id == account_id).first()
+
+        if tenant:
+            tenant_id = str(tenant.id)
+        else:
+            # Core INSERT ... RETURNING: the tenant id comes back with the
+            # insert itself, with no unit-of-work flush in between.
+            tenant_id = session.execute(
+                insert(Tenant).values(
+                    name=f"{account_name}'s Workspace",
+                    created_at=now,
+                    updated_at=now,
+                ).returning(Tenant.id)
+            ).scalar_one()
+            session.execute(
+                insert(TenantAccountJoin).values(
+                    tenant_id=tenant_id,
+                    account_id=account_id,
+                    role="owner",
+                    current=True,
+                    created_at=now,
+                    updated_at=now,
+                )
             )
-            session.add(ta)
-            session.commit()
-            logging.info(f"Created new tenant {tenant.id} for account {account.id}")
-        return tenant
+            tenant_id = str(tenant_id)
+            logger.info("Created new tenant %s for account %s", tenant_id, account_id)
+        return tenant_id
 
     def process_dify_login(self, user_info: dict, redirect_uri: str) -> Response:
         """
@@ -184,103 +377,157 @@ class CasdoorDifyPluginEndpoint(Endpoint):
         name = user_info.get("name") or (email.split("@")[0] if email else "User")
         open_id = user_info.get("sub") or user_info.get("id")
         if not email or not open_id:
-            logging.error("Insufficient user information from Casdoor.")
+            logger.error("Insufficient user information from Casdoor.")
             return Response("Insufficient user information from Casdoor.", status=400)
 
-        # Connect to the PostgreSQL database (exact same as FastAPI)
-        engine = create_engine(DATABASE_URL)
-        Base = automap_base()
-        Base.prepare(engine, reflect=True)
-        Session = sessionmaker(bind=engine)
-        session = Session()
-
-        if "accounts" not in Base.classes.keys():
-            session.close()
-            logging.error("Accounts table not found in database schema.")
-            return Response("Accounts table not found in database schema.", status=500)
-        Account = Base.classes.accounts
-
-        # Find or create account by email (exact same as FastAPI)
-        account = session.query(Account).filter_by(email=email).first()
-        if account:
-            logging.info(f"Existing account found for email: {email}")
-        else:
-            logging.info(f"No account found for email: {email}. Creating a new account.")
-            account = Account(
-                email=email,
-                name=name,
-                status="active",
-                created_at=datetime.datetime.utcnow(),
-                updated_at=datetime.datetime.utcnow(),
-                initialized_at=datetime.datetime.utcnow()
-            )
-            session.add(account)
-            session.commit()
-
-        account_id = str(account.id)
-
-        # Link Casdoor identity via account_integrates table (exact same as FastAPI)
-        mapped_tables = [t.lower() for t in Base.classes.keys()]
-        if "account_integrates" in mapped_tables:
-            actual_table_name = [t for t in Base.classes.keys() if t.lower() == "account_integrates"][0]
-            AccountIntegrates = getattr(Base.classes, actual_table_name)
-            integrate = session.query(AccountIntegrates).filter_by(account_id=account_id, provider="casdoor").first()
-            if integrate:
-                integrate.open_id = open_id
-                logging.info(f"Updated account_integrates for account {account_id}.")
+        # One timestamp for the whole request: avoids repeated clock reads
+        # and guarantees paired rows get identical created_at/updated_at.
+        # (utcnow() is deprecated since 3.12; the naive equivalent is kept
+        # because the Dify columns are timezone-naive.)
+        now = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+        session = _SESSION_FACTORY()
+        try:
+            # One round-trip loads the account together with its Casdoor
+            # identity link and whether any tenant join exists. Explicit
+            # join conditions are used because the Dify schema declares no
+            # foreign keys to hang ORM relationships on.
+            row = session.execute(
+                select(Account, AccountIntegrate, TenantAccountJoin.tenant_id)
+                .outerjoin(AccountIntegrate, and_(
+                    AccountIntegrate.account_id == Account.id,
+                    AccountIntegrate.provider == "casdoor",
+                ))
+                .outerjoin(TenantAccountJoin, TenantAccountJoin.account_id == Account.id)
+                .where(Account.email == email)
+                .limit(1)
+            ).first()
+            account, integrate, tenant_id = row if row is not None else (None, None, None)
+            wrote = False
+
+            if account is None:
+                # Plain insert: Dify's accounts table only has the
+                # non-unique account_email_idx, so there is no conflict
+                # target for ON CONFLICT. The SELECT above gates existence,
+                # matching the baseline's find-or-create semantics.
+                account_stmt = insert(Account).values(
+                    email=email,
+                    name=name,
+                    status="active",
+                    created_at=now,
+                    updated_at=now,
+                    initialized_at=now,
+                ).returning(Account.id, Account.name)
+                account_row = session.execute(account_stmt).one()
+                account_id = str(account_row.id)
+                account_name = account_row.name
+                wrote = True
             else:
-                new_integrate = AccountIntegrates(
+                account_id = str(account.id)
+                account_name = account.name
+
+            if integrate is None:
+                integrate_stmt = pg_insert(AccountIntegrate).values(
                     account_id=account_id,
                     provider="casdoor",
                     open_id=open_id,
                     encrypted_token="",  # Satisfy NOT NULL constraint
-                    created_at=datetime.datetime.utcnow(),
-                    updated_at=datetime.datetime.utcnow()
+                    created_at=now,
+                    updated_at=now,
+                ).on_conflict_do_update(
+                    index_elements=["account_id", "provider"],
+                    set_={"open_id": open_id, "updated_at": now},
                 )
-                session.add(new_integrate)
-                logging.info(f"Created new account_integrates for account {account_id}.")
-            session.commit()
-        else:
+                session.execute(integrate_stmt)
+                wrote = True
+            elif integrate.open_id != open_id:
+                integrate.open_id = open_id
+                integrate.updated_at = now
+                wrote = True
+
+            # Ensure tenant exists for the account, then land everything
+            # (account, integrate, tenant, join) in a single commit. The
+            # steady-state login (everything already in place) performs no
+            # writes at all, so it skips the COMMIT and its WAL fsync.
+            if tenant_id is None:
+                self.ensure_tenant(account_id, account_name, session, now)
+                wrote = True
+            if wrote:
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
             session.close()
-            logging.error("account_integrates table not found in database.")
-            return Response("account_integrates table not found in database.", status=500)
-
-        # Ensure tenant exists for the account (exact same as FastAPI)
-        self.ensure_tenant(account, session, Base)
 
         # Generate tokens in a Dify-like format (exact same as FastAPI)
         console_token = self.generate_dify_access_token(account_id, expire_minutes=60, edition="dify")
         refresh_token = self.generate_dify_refresh_token(account_id)
 
         # Redirect with tokens as query parameters (mimicking Dify's OAuth flow, exact same as FastAPI)
-        redirect_url = f"{redirect_uri}?access_token={console_token}&refresh_token={refresh_token}"
-        response = Response(status=302)
-        response.headers["Location"] = redirect_url
-
-        # Set cookies with exact same attributes as FastAPI
-        response.set_cookie(
-            key="console_token",
-            value=console_token,
-            httponly=True,
-            secure=False,  # Set to True if using HTTPS
-            max_age=60*60,  # 1 hour
-            domain=DOMAIN,
-            path="/"
-        )
-        response.set_cookie(
-            key="refresh_token",
-            value=refresh_token,
-            httponly=True,
-            secure=False,  # Set to True if using HTTPS
-            max_age=30*24*3600,  # 30 days
-            domain=DOMAIN,
-            path="/"
-        )
+        # Append with the right separator so a redirect_uri that already
+        # carries a query string still produces a valid URL.
+        sep = "&" if "?" in redirect_uri else "?"
+        redirect_url = f"{redirect_uri}{sep}access_token={console_token}&refresh_token={refresh_token}"
+        response = self._redirect(redirect_url)
+
+        # Same cookie attributes as before, but via precomputed header
+        # values; both tokens are base64url/urlsafe so no escaping is needed.
+        response.headers.add("Set-Cookie", _CONSOLE_COOKIE_TMPL.format(console_token))
+        response.headers.add("Set-Cookie", _REFRESH_COOKIE_TMPL.format(refresh_token))
+
+        logger.debug("Redirecting user to %s with tokens.", redirect_url)
+        return response
 
-        session.close()
-        logging.info(f"Redirecting user to {redirect_url} with tokens.")
+    @staticmethod
+    def _redirect(url: str) -> Response:
+        response = Response(status=302)
+        response.headers["Location"] = url
         return response
 
+    def _handle_login(self, r: Request, redirect_uri: str) -> Response:
+        url = self.get_casdoor_login_url(redirect_uri)
+        logger.debug("Redirecting to Casdoor login: %s", url)
+        return self._redirect(url)
+
+    def _handle_signup(self, r: Request, redirect_uri: str) -> Response:
+        url = self.get_casdoor_signup_url(redirect_uri)
+        logger.debug("Redirecting to Casdoor signup: %s", url)
+        return self._redirect(url)
+
+    def _handle_callback(self, r: Request, redirect_uri: str) -> Response:
+        code = r.args.get("code")
+        if not code:
+            logger.error("Missing authorization code in callback")
+            return Response("Missing authorization code", status=400)
+        # Never log the raw authorization code; a short hash is enough
+        # to correlate a callback in the logs.
+        if logger.isEnabledFor(logging.DEBUG):
+            code_digest = hashlib.sha256(code.encode("utf-8")).hexdigest()[:8]
+            logger.debug("Received callback with code sha256[:8]=%s", code_digest)
+
+        try:
+            token_info = self.get_oauth_token(code)
+            id_token = token_info.get("id_token")
+            if not id_token:
+                logger.error("Token response missing id_token")
+                return Response("Token response missing id_token", status=400)
+
+            user_info = self.parse_jwt_token(id_token)
+            logger.info("JWT token parsed successfully.")
+        except Exception as e:
+            logger.exception("Error during token processing")
+            return Response(f"Error: {str(e)}", status=400)
+
+        # Redirect to Dify main page with tokens, matching FastAPI
+        return self.process_dify_login(user_info, redirect_uri=DOMAIN)
+
+    # Action name -> unbound handler; resolved against self in _invoke.
+    _ACTIONS = {
+        "login": _handle_login,
+        "signup": _handle_signup,
+        "callback": _handle_callback,
+    }
+
     def _invoke(self, r: Request, values: Mapping, settings: Mapping) -> Response:
         """
         Invokes the endpoint based on the query parameter "action".
@@ -290,48 +537,13 @@ class CasdoorDifyPluginEndpoint(Endpoint):
           - ?action=callback to handle the OAuth callback
         """
         action = r.args.get("action", "login")
-        logging.info(f"Received action: {action}")
+        logger.info("Received action: %s", action)
+
+        handler = self._ACTIONS.get(action)
+        if handler is None:
+            logger.error("Invalid action: %s", action)
+            return Response("Invalid action", status=400)
 
         # Use redirect_uri from settings or fallback to the hardcoded value from FastAPI
         redirect_uri = settings.get("redirect_uri", DOMAIN)
-
-        if action == "login":
-            url = self.get_casdoor_login_url(redirect_uri)
-            logging.info(f"Redirecting to Casdoor login: {url}")
-            response = Response(status=302)
-            response.headers["Location"] = url
-            return response
-
-        elif action == "signup":
-            url = self.get_casdoor_signup_url(redirect_uri)
-            logging.info(f"Redirecting to Casdoor signup: {url}")
-            response = Response(status=302)
-            response.headers["Location"] = url
-            return response
-
-        elif action == "callback":
-            code = r.args.get("code")
-            if not code:
-                logging.error("Missing authorization code in callback")
-                return Response("Missing authorization code", status=400)
-            logging.info(f"Received callback with code: {code}")
-
-            try:
-                token_info = self.get_oauth_token(code)
-                id_token = token_info.get("id_token")
-                if not id_token:
-                    logging.error("Token response missing id_token")
-                    return Response("Token response missing id_token", status=400)
-
-                user_info = self.parse_jwt_token(id_token)
-                logging.info("JWT token parsed successfully.")
-            except Exception as e:
-                logging.exception("Error during token processing")
-                return Response(f"Error: {str(e)}", status=400)
-
-            # Redirect to Dify main page with tokens, matching FastAPI
-            return self.process_dify_login(user_info, redirect_uri=DOMAIN)
-
-        else:
-            logging.error(f"Invalid action: {action}")
-            return Response("Invalid action", status=400)
+        return handler(self, r, redirect_uri)